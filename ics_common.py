@@ -0,0 +1,32 @@
+from datetime import datetime, timezone
+
+# Gemeinsame ICS-Bausteine für untis_to_ics.py und untis_to_caldav.py → beide erzeugen identische VEVENT-Zeilen
+ICS_HEADER = "BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//untis-cal-sync//DE\r\n"
+ICS_FOOTER = "END:VCALENDAR\r\n"
+
+def localize(dt, tz):
+    # WebUntis liefert naive Zeiten in Schul-Lokalzeit → tzinfo nur anhängen
+    if dt is None: return None
+    return dt.replace(tzinfo=tz) if dt.tzinfo is None else dt.astimezone(tz)
+
+def ics_escape(text: str) -> str:
+    return (text.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,")
+                .replace("\n", "\\n").replace("\r", "\\r"))
+
+def ics_fold(line: str) -> str:
+    # RFC 5545: Zeilen über 75 Oktette umbrechen, ohne UTF-8-Zeichen zu zerteilen
+    raw = line.encode("utf-8")
+    if len(raw) <= 75: return line
+    parts, limit = [], 75
+    while len(raw) > limit:
+        cut = limit
+        while (raw[cut] & 0xC0) == 0x80: cut -= 1
+        parts.append(raw[:cut].decode("utf-8"))
+        raw, limit = raw[cut:], 74
+    parts.append(raw.decode("utf-8"))
+    return "\r\n ".join(parts)
+
+def ics_utc(dt: datetime) -> str:
+    # feste Breite → direkt formatieren statt strftime
+    u = dt.astimezone(timezone.utc)
+    return f"{u.year:04d}{u.month:02d}{u.day:02d}T{u.hour:02d}{u.minute:02d}{u.second:02d}Z"
@@ -0,0 +1,51 @@
+from dataclasses import replace
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+import vobject
+
+import untis_to_caldav as sync
+
+TZ = ZoneInfo("Europe/Berlin")
+
+
+class StoredEvent:
+    # Wie caldav.Event: geparstes VEVENT unter vobject_instance
+    def __init__(self, data):
+        self.vobject_instance = vobject.readOne(data)
+
+
+def make_details(**changes):
+    begin = datetime(2025, 3, 10, 8, 0, tzinfo=TZ)
+    details = sync.LessonDetails(
+        begin=begin,
+        end=begin + timedelta(minutes=45),
+        subject="Mathematik",
+        room="R101",
+        teachers="Müller",
+        code=None,
+        subst=None,
+        uid=sync.lesson_uid(begin, "Mathematik", "R101", "Müller"),
+    )
+    return replace(details, **changes)
+
+
+def stored(details):
+    return StoredEvent(sync.ICS_HEADER + sync.build_event(details) + sync.ICS_FOOTER)
+
+
+def test_unchanged_event_is_kept():
+    details = make_details()
+    assert sync.event_matches(stored(details), details)
+
+
+def test_changed_end_is_uploaded_again():
+    details = make_details()
+    moved = replace(details, end=details.end + timedelta(minutes=15))
+    assert moved.uid == details.uid
+    assert not sync.event_matches(stored(details), moved)
+
+
+def test_changed_note_is_uploaded_again():
+    details = make_details()
+    assert not sync.event_matches(stored(details), replace(details, subst="Raumänderung"))
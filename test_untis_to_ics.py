@@ -0,0 +1,45 @@
+from datetime import date, datetime, timedelta
+
+import untis_to_ics as ics
+
+WED = date(2025, 3, 12)
+
+
+def test_several_weekdays_pick_earliest_of_week():
+    # wie die alte Schleife über WEEKDAYS_DE: Montag vor Freitag, auch wenn Freitag näher liegt
+    assert ics.parse_due_date("abgabe freitag oder montag", WED) == date(2025, 3, 17)
+
+
+def test_weekday_equal_to_base_day_means_next_week():
+    assert ics.parse_due_date("bis mittwoch", WED) == WED + timedelta(days=7)
+
+
+def test_upper_case_text_is_parsed():
+    assert ics.parse_due_date("Abgabe Freitag", WED) == date(2025, 3, 14)
+
+
+def test_ddmm_before_base_day_rolls_into_next_year():
+    assert ics.parse_due_date("abgabe 10.01.", WED) == date(2026, 1, 10)
+    assert ics.parse_due_date("abgabe 20.03.", WED) == date(2025, 3, 20)
+
+
+def test_invalid_date_is_ignored():
+    assert ics.parse_due_date("abgabe 31.02.", WED) is None
+    assert ics.parse_due_date("abgabe 31.02.2025", WED) is None
+
+
+def test_merge_into_blocks_sorts_unordered_lessons():
+    at = lambda h, m: datetime(2025, 3, 12, h, m)
+    intervals = [(at(9, 40), at(10, 25)), (at(8, 0), at(8, 45)), (at(8, 50), at(9, 35)), (at(13, 0), at(13, 45))]
+    assert ics.merge_into_blocks(intervals) == [(at(8, 0), at(10, 25)), (at(13, 0), at(13, 45))]
+
+
+def test_next_subject_day_without_match_in_35_days():
+    subject_days = {"mathematik": [WED - timedelta(days=1), WED + timedelta(days=36)]}
+    assert ics.next_subject_day("Mathematik", subject_days, WED) == WED + timedelta(days=1)
+    assert ics.next_subject_day("Physik", subject_days, WED) == WED + timedelta(days=1)
+
+
+def test_next_subject_day_picks_first_later_lesson():
+    subject_days = {"mathematik": [WED, WED + timedelta(days=2), WED + timedelta(days=35)]}
+    assert ics.next_subject_day("Mathematik", subject_days, WED) == WED + timedelta(days=2)
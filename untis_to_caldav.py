@@ -1,13 +1,23 @@
 import os
 import sys
-import pytz
+import json
+import hashlib
+import requests
 import webuntis
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime, timedelta
-from dateutil.parser import isoparse
-from caldav import DAVClient
+from zoneinfo import ZoneInfo
+from caldav import DAVClient, Calendar as DAVCalendar
 from caldav.lib.error import NotFoundError
-from ics import Event
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from ics_common import ICS_HEADER, ICS_FOOTER, localize, ics_escape, ics_fold, ics_utc
+
+CACHE_DIR = os.path.expanduser("~/.cache/untis-cal-sync")
+CALENDAR_CACHE = os.path.join(CACHE_DIR, "calendars.json")
 
 def get_env(name, default=None, required=False):
     v = os.getenv(name, default)
@@ -17,7 +27,6 @@ def get_env(name, default=None, required=False):
     return v
 
 def login_session():
-    def login_session():
     s = webuntis.Session(
         server=get_env("WEBUNTIS_SERVER", required=True),
         school=get_env("WEBUNTIS_SCHOOL", required=True),
@@ -25,8 +34,8 @@ def login_session():
         password=get_env("WEBUNTIS_PASSWORD", required=True),
         useragent=get_env("WEBUNTIS_CLIENT", "untis-cal-sync"),
     )
-    return s.login()
-
+    s.login()
+    return s
 
 def pick_scope(session):
     try:
@@ -59,7 +68,148 @@ def fetch_timetable(session, scope, start, end):
         kw["personId"] = scope["personId"]
     return session.timetable(**kw)
 
-def get_icloud_calendar(client, name):
+@dataclass(slots=True, frozen=True)
+class LessonDetails:
+    begin: datetime
+    end: datetime
+    subject: str
+    room: str
+    teachers: str
+    code: str | None
+    subst: str | None
+    uid: str
+
+def lesson_refs(lesson):
+    # Fach-/Raum-/Lehrer-ids einer Lesson mit einem Zugriff auf die Rohdaten
+    data = getattr(lesson, "_data", None) or {}
+    return (tuple([x.get("id") for x in data.get("su", ())]),
+            tuple([x.get("id") for x in data.get("ro", ())]),
+            tuple([x.get("id") for x in data.get("te", ())]))
+
+def referenced_ids(refs, pos):
+    # ids einer Kategorie (0 = Fach, 1 = Raum, 2 = Lehrer) über alle Lessons
+    ids = {i for r in refs for i in r[pos]}
+    ids.discard(None)
+    return ids
+
+def load_id_map(fetch, ids):
+    # Stammdaten einmal laden → id-Lookups pro Lesson ohne weitere RPCs; nur referenzierte ids behalten
+    if not ids:
+        return {}
+    try:
+        return {o.id: o for o in fetch() if o.id in ids}
+    except Exception:
+        return {}
+
+def joined_names(ids, id_map, cache, use_long_name=True):
+    # Namen je id-Tupel nur einmal zusammensetzen (Fach/Raum/Lehrer wiederholen sich über die Woche)
+    names = cache.get(ids)
+    if names is None:
+        objs = [id_map[i] for i in ids if i in id_map]
+        names = cache[ids] = ", ".join(
+            (getattr(o, "long_name", None) if use_long_name else None) or o.name for o in objs
+        )
+    return names
+
+def lesson_uid(begin, subject_name, room, teachers):
+    # Kurze, stabile UID (32 Hex-Zeichen) statt langem Klartext-Schlüssel
+    data = int(begin.timestamp()).to_bytes(8, "big") + f"|{subject_name}|{room}|{teachers}".encode("utf-8")
+    return hashlib.blake2b(data, digest_size=16).hexdigest() + "@untis-cal-sync"
+
+def lesson_notes(details):
+    notes_parts = []
+    if details.teachers:
+        notes_parts.append(f"Lehrkraft: {details.teachers}")
+    if details.code:
+        notes_parts.append(f"Code: {details.code}")
+    if details.subst:
+        notes_parts.append(f"Hinweis: {details.subst}")
+    return "\n".join(notes_parts)
+
+def lesson_title(details):
+    title = details.subject
+    if details.room:
+        title += f" · {details.room}"
+    return title
+
+def build_event(details):
+    # VEVENT direkt als Text (ohne ics-Objektgraph)
+    title = lesson_title(details)
+    notes = lesson_notes(details)
+
+    lines = ["BEGIN:VEVENT"]
+    if notes:
+        lines.append(f"DESCRIPTION:{ics_escape(notes)}")
+    lines += [f"DTEND:{ics_utc(details.end)}", f"DTSTART:{ics_utc(details.begin)}"]
+    if details.room:
+        lines.append(f"LOCATION:{ics_escape(details.room)}")
+    lines += [f"SUMMARY:{ics_escape(title)}", f"UID:{details.uid}", "END:VEVENT"]
+    return "\r\n".join(ics_fold(x) for x in lines) + "\r\n"
+
+def _event_field(ev, name):
+    # Feld aus einem vorhandenen CalDAV-Event lesen ("" falls nicht vorhanden)
+    try:
+        return getattr(ev.vobject_instance.vevent, name).value
+    except Exception:
+        return ""
+
+def event_matches(ev, details):
+    # Vorhandenes Event nur behalten, wenn alle geschriebenen Felder gleich sind –
+    # die UID enthält z. B. das Stundenende nicht, ein verschobenes Ende muss neu hochgeladen werden
+    return (_event_field(ev, "dtstart") == details.begin
+            and _event_field(ev, "dtend") == details.end
+            and _event_field(ev, "summary") == lesson_title(details)
+            and _event_field(ev, "location") == details.room
+            and _event_field(ev, "description") == lesson_notes(details))
+
+def pooled_http_session(http=None):
+    # Ein TLS-Handshake für alle PROPFIND/REPORT/PUT/DELETE-Requests
+    http = http or requests.Session()
+    retry = Retry(total=3, backoff_factor=0.3, status_forcelist=(502, 503, 504))
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+    http.mount("https://", adapter)
+    return http
+
+def _safe_delete(ev):
+    try:
+        ev.delete()
+    except Exception:
+        pass
+
+def _load_calendar_cache():
+    try:
+        with open(CALENDAR_CACHE, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _store_calendar_cache(cache):
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(CALENDAR_CACHE, "w", encoding="utf-8") as f:
+            json.dump(cache, f)
+    except OSError:
+        pass
+
+def get_icloud_calendar(client, name, username):
+    # Gecachte Kalender-URL → principal()/calendars()-PROPFINDs überspringen
+    cache = _load_calendar_cache()
+    key = f"{username}|{name}"
+    cached_url = cache.get(key)
+    if cached_url:
+        try:
+            c = DAVCalendar(client=client, url=cached_url, name=name)
+            if c.get_display_name() == name:
+                return c
+        except Exception:
+            pass
+
+    cal = _discover_calendar(client, name)
+    cache[key] = str(cal.url)
+    _store_calendar_cache(cache)
+    return cal
+
+def _discover_calendar(client, name):
     principal = client.principal()
     try:
         calendars = principal.calendars()
@@ -67,9 +217,11 @@ def get_icloud_calendar(client, name):
         print("Fehler beim Laden der Kalender:", e, file=sys.stderr)
         sys.exit(3)
 
-    for c in calendars:
-        if c.name == name:
-            return c
+    # Namen kommen aus demselben PROPFIND wie die Kalenderliste (displayname),
+    # einmal indexieren statt pro Kalender zu vergleichen; bei Duplikaten gewinnt der erste
+    by_name = {c.name: c for c in reversed(calendars)}
+    if name in by_name:
+        return by_name[name]
 
     # Falls nicht vorhanden → erstellen
     return principal.make_calendar(name=name)
@@ -77,15 +229,52 @@ def get_icloud_calendar(client, name):
 def main():
     load_dotenv()
     tzname = get_env("TIMEZONE", "Europe/Berlin")
-    tz = pytz.timezone(tzname)
+    tz = ZoneInfo(tzname)
 
     session = login_session()
     try:
-        start = datetime.now(tz).date()
-        end = (datetime.now(tz) + timedelta(days=14)).date()
+        now = datetime.now(tz)
+        start = now.date()
+        end = (now + timedelta(days=14)).date()
+
+        # Stammdaten parallel zu Scope + Stundenplan laden (alles wartet nur aufs Netz)
+        with ThreadPoolExecutor(max_workers=3) as ex:
+            subjects_future = ex.submit(session.subjects)
+            rooms_future = ex.submit(session.rooms)
+            teachers_future = ex.submit(session.teachers)
+            scope = pick_scope(session)
+            lessons = fetch_timetable(session, scope, start, end)
+
+        # Lessons ohne Start/Ende gleich verwerfen (keine UID/Zeiten möglich)
+        lessons = [l for l in lessons if getattr(l, "start", None) and getattr(l, "end", None)]
+
+        # Neue Events erzeugen
+        lesson_details = []
+
+        refs = [lesson_refs(l) for l in lessons]
+        subject_map = load_id_map(subjects_future.result, referenced_ids(refs, 0))
+        room_map = load_id_map(rooms_future.result, referenced_ids(refs, 1))
+        teacher_map = load_id_map(teachers_future.result, referenced_ids(refs, 2))
+        subject_names, room_names, teacher_names = {}, {}, {}
 
-        scope = pick_scope(session)
-        lessons = fetch_timetable(session, scope, start, end)
+        for l, (su_ids, ro_ids, te_ids) in zip(lessons, refs):
+            begin = localize(l.start, tz)
+            finish = localize(l.end, tz)
+
+            subject_name = joined_names(su_ids[:1], subject_map, subject_names) or "Unterricht"
+            room = joined_names(ro_ids, room_map, room_names, use_long_name=False)
+            teachers = joined_names(te_ids, teacher_map, teacher_names)
+
+            lesson_details.append(LessonDetails(
+                begin=begin,
+                end=finish,
+                subject=subject_name,
+                room=room,
+                teachers=teachers,
+                code=getattr(l, "code", None),
+                subst=getattr(l, "substText", None),
+                uid=lesson_uid(begin, subject_name, room, teachers),
+            ))
 
         # iCloud CalDAV
         username = get_env("ICLOUD_USERNAME", required=True)
@@ -95,70 +284,41 @@ def main():
         # iCloud CalDAV URL (Entdeckung über Standard-Endpoint)
         # caldav lib findet die richtige URL via .principal()
         client = DAVClient(url="https://caldav.icloud.com/", username=username, password=app_pw)
+        pooled_http_session(client.session)
 
-        cal = get_icloud_calendar(client, cal_name)
+        cal = get_icloud_calendar(client, cal_name, username)
 
-        # Für idempotentes Update: existierende Events dieses Fensters löschen (einfachster Weg)
-        # Alternativ: pro-UID updaten.
+        # Abgleich per UID: nur neue/geänderte Events hochladen, veraltete löschen
+        new = {d.uid: d for d in lesson_details}
+        old, stale = {}, []
         try:
             existing = cal.date_search(
-                start=datetime.now(tz) - timedelta(days=1),
-                end=datetime.now(tz) + timedelta(days=30)
+                start=now - timedelta(days=1),
+                end=now + timedelta(days=30)
             )
             for ev in existing:
-                try:
-                    ev.delete()
-                except Exception:
-                    pass
+                uid = _event_field(ev, "uid")
+                if uid:
+                    old[uid] = ev
+                else:
+                    stale.append(ev)
         except NotFoundError:
             pass
 
-        # Neue Events erzeugen
-        from ics import Calendar
-        tmp_cal = Calendar()
-
-        for l in lessons:
-            try:
-                begin = tz.localize(l.start)
-                finish = tz.localize(l.end)
-            except Exception:
-                begin = l.start
-                finish = l.end
-
-            subject = getattr(l, "subject", None)
-            subject_name = getattr(subject, "long_name", None) or getattr(subject, "name", None) or "Unterricht"
-            room = ", ".join(r.name for r in getattr(l, "rooms", []) if hasattr(r, "name")) or ""
-            teachers = ", ".join(t.long_name or t.name for t in getattr(l, "teachers", []) if hasattr(t, "name"))
-
-            title = subject_name
-            if room:
-                title += f" · {room}"
-
-            e = Event()
-            e.name = title
-            e.begin = begin
-            e.end = finish
-            e.location = room or None
-
-            notes_parts = []
-            if teachers:
-                notes_parts.append(f"Lehrkraft: {teachers}")
-            code = getattr(l, "code", None)
-            if code:
-                notes_parts.append(f"Code: {code}")
-            if getattr(l, "substText", None):
-                notes_parts.append(f"Hinweis: {l.substText}")
-            if notes_parts:
-                e.description = "\n".join(notes_parts)
-
-            uid_key = f"{begin.isoformat()}|{subject_name}|{room}|{teachers}"
-            e.uid = uid_key
-
-            tmp_cal.events.add(e)
-
-        # Alles in einem Upload hinzufügen
-        cal.add_event(tmp_cal)
-        print("iCloud Kalender aktualisiert.")
+        stale += [old[u] for u in old.keys() - new.keys()]
+        upload = [new[u] for u in new.keys() - old.keys()]
+        upload += [new[u] for u in new.keys() & old.keys() if not event_matches(old[u], new[u])]
+
+        # Ein PUT pro Event, parallel über die gepoolten Verbindungen
+        def _put(details):
+            cal.add_event(ICS_HEADER + build_event(details) + ICS_FOOTER)
+
+        with ThreadPoolExecutor(max_workers=8) as ex:
+            deleted = ex.map(_safe_delete, stale)
+            uploaded = ex.map(_put, upload)
+            list(deleted)
+            list(uploaded)
+        print(f"iCloud Kalender aktualisiert: {len(upload)} hochgeladen, {len(stale)} gelöscht.")
     finally:
         try:
             session.logout()
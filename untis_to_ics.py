@@ -1,13 +1,29 @@
 import os
 import sys
 import re
+import json
+import hashlib
+import tempfile
+from bisect import bisect_right
+from collections import defaultdict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from operator import itemgetter
 from datetime import datetime, timedelta, time, date
+from zoneinfo import ZoneInfo
 
-import pytz
 import webuntis
-from ics import Calendar, Event
+from webuntis.objects import PeriodList
 from dotenv import load_dotenv
 
+from ics_common import ICS_HEADER, ICS_FOOTER, localize, ics_escape, ics_fold, ics_utc
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
 # ==================== ENV ====================
 def get_env(name: str, default=None, required: bool = False):
     v = os.getenv(name, default)
@@ -56,6 +72,73 @@ def fetch_timetable(session, scope, start, end):
         raise RuntimeError("Unbekannter Scope für timetable().")
     return session.timetable(**kw)
 
+CACHE_DIR = os.path.expanduser("~/.cache/untis-cal-sync")
+
+def _timetable_cache_path(scope, start, end):
+    key = json.dumps(scope, sort_keys=True).encode() + start.isoformat().encode() + end.isoformat().encode()
+    return os.path.join(CACHE_DIR, f"tt-{hashlib.blake2b(key, digest_size=16).hexdigest()}.json")
+
+def _read_cached_timetable(session, path, ttl):
+    try:
+        if datetime.now().timestamp() - os.path.getmtime(path) < ttl:
+            with open(path, encoding="utf-8") as f:
+                return PeriodList(data=json.load(f), session=session)
+    except (OSError, ValueError):
+        pass
+    return None
+
+def _prune_timetable_cache(keep, ttl):
+    # Schlüssel enthält das Datum → Einträge vergangener Tage verfallen sonst nie; abgelaufene löschen
+    cutoff = datetime.now().timestamp() - ttl
+    try: entries = list(os.scandir(CACHE_DIR))
+    except OSError: return
+    for e in entries:
+        if not (e.name.startswith("tt-") and e.name.endswith(".json")) or e.path == keep: continue
+        try:
+            if e.stat().st_mtime < cutoff: os.remove(e.path)
+        except OSError: pass
+
+@contextmanager
+def _cache_lock(path):
+    # Überlappende Läufe (cron) warten aufeinander statt doppelt abzufragen; ohne fcntl (Windows) kein Lock
+    try: lf = open(path + ".lock", "w") if fcntl else None
+    except OSError: lf = None
+    if lf is None:
+        yield
+        return
+    with lf:
+        fcntl.flock(lf, fcntl.LOCK_EX)
+        try: yield
+        finally: fcntl.flock(lf, fcntl.LOCK_UN)
+
+def fetch_timetable_cached(session, scope, start, end, ttl):
+    # Rohdaten der letzten Abfrage für `ttl` Sekunden wiederverwenden (0 = aus)
+    path = _timetable_cache_path(scope, start, end)
+    if ttl <= 0:
+        return fetch_timetable(session, scope, start, end)
+    lessons = _read_cached_timetable(session, path, ttl)
+    if lessons is not None: return lessons
+    try: os.makedirs(CACHE_DIR, exist_ok=True)
+    except OSError: pass
+    with _cache_lock(path):
+        # ein paralleler Lauf hat den Cache evtl. gerade gefüllt
+        lessons = _read_cached_timetable(session, path, ttl)
+        if lessons is not None: return lessons
+        try:
+            lessons = fetch_timetable(session, scope, start, end)
+        except Exception:
+            try: os.remove(path)
+            except OSError: pass
+            raise
+        try:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump([l._data for l in lessons], f)
+        except (OSError, TypeError):
+            pass
+        else:
+            _prune_timetable_cache(path, ttl)
+    return lessons
+
 # ==================== HA-/Prüfungs-Erkennung ====================
 EXAM_KEYWORDS = [
     "prüfung", "klausur", "arbeit", "test", "leistungskontrolle",
@@ -72,32 +155,39 @@ HOMEWORK_HINTS = [
     "essay", "vocab", "wb", "tb", "prepare", "study",
     "presentation", "project"
 ]
+# Je eine Alternation statt any(k in low ...) → ein Durchlauf über den Text
+EXAM_RE     = re.compile("|".join(map(re.escape, EXAM_KEYWORDS)))
+HOMEWORK_RE = re.compile("|".join(map(re.escape, HOMEWORK_HINTS)))
+
+CANCEL_CODES = frozenset({"cancelled", "canc", "absent"})
 
 WEEKDAYS_DE = {"montag":0,"dienstag":1,"mittwoch":2,"donnerstag":3,"freitag":4,"samstag":5,"sonntag":6}
+WEEKDAY_RE = re.compile("|".join(WEEKDAYS_DE))
 DATE_DDMMYYYY = re.compile(r"\b(\d{1,2})\.(\d{1,2})\.(\d{4})\b")
 DATE_DDMM      = re.compile(r"\b(\d{1,2})\.(\d{1,2})\b")
 
 def extract_info_text(lesson) -> str:
-    parts = []
-    for key in ("substText","info"):
-        v = getattr(lesson, key, None)
-        if isinstance(v, str) and v.strip(): parts.append(v.strip())
     raw = getattr(lesson, "_data", {}) or {}
-    for key in ("txt","lsnote","notice"):
-        v = raw.get(key)
-        if isinstance(v, str) and v.strip(): parts.append(v.strip())
-    return "\n".join(parts)
+    vals = (getattr(lesson, "substText", None), getattr(lesson, "info", None),
+            raw.get("txt"), raw.get("lsnote"), raw.get("notice"))
+    if not any(vals): return ""  # häufigster Fall: Stunde ohne Text
+    return "\n".join(v.strip() for v in vals if isinstance(v, str) and v.strip())
 
+# Stehende Hinweise wiederholen sich jede Woche → Ergebnisse je Text (und Tag) merken
+@lru_cache(maxsize=1024)
 def parse_due_date(text: str, base_day: date):
     if not text: return None
-    t = text.lower()
+    t = text.lower()  # Aufrufer übergeben meist schon info_low; für bereits kleinen Text kostet das fast nichts
     if "heute" in t:  return base_day
     if "morgen" in t: return base_day + timedelta(days=1)
-    for w, idx in WEEKDAYS_DE.items():
-        if w in t:
-            d = (idx - base_day.weekday()) % 7
-            d = 7 if d == 0 else d
-            return base_day + timedelta(days=d)
+    found = WEEKDAY_RE.findall(t)
+    if found:
+        # ein Scan statt sieben; bei mehreren Wochentagen gewinnt wie bisher der früheste der Woche
+        idx = min(WEEKDAYS_DE[w] for w in found)
+        d = (idx - base_day.weekday()) % 7
+        d = 7 if d == 0 else d
+        return base_day + timedelta(days=d)
+    if "." not in t: return None  # beide Datumsformate brauchen einen Punkt
     m = DATE_DDMMYYYY.search(t)
     if m:
         d, mth, y = map(int, m.groups())
@@ -113,178 +203,182 @@ def parse_due_date(text: str, base_day: date):
         except Exception: pass
     return None
 
-def contains_homework(text: str) -> bool:
-    if not text: return False
-    low = text.lower()
-    return any(h in low for h in HOMEWORK_HINTS)
+@lru_cache(maxsize=1024)
+def contains_homework(low: str) -> bool:
+    return bool(low) and HOMEWORK_RE.search(low) is not None
 
-def detect_exam(text: str) -> bool:
-    if not text: return False
-    low = text.lower()
-    return any(k in low for k in EXAM_KEYWORDS)
+@lru_cache(maxsize=1024)
+def detect_exam(low: str) -> bool:
+    return bool(low) and EXAM_RE.search(low) is not None
 
 # ==================== Fächer & Hilfsfunktionen ====================
-def get_subject_names(session, lesson):
-    names = []
+def load_subject_map(fetch_subjects, lessons):
+    # Fächer einmal laden → id-Lookups pro Lesson ohne weitere RPCs; nur referenzierte ids behalten,
+    # Anzeigename (long_name vor name) gleich hier auflösen statt je Lesson
+    ids = {x.get("id") for l in lessons for x in (getattr(l, "_data", {}) or {}).get("su", [])}
+    ids.discard(None)
+    if not ids: return {}
     try:
-        data = getattr(lesson, "_data", {}) or {}
-        for x in data.get("su", []):
-            sid = x.get("id")
-            if not sid: continue
-            try:
-                subj = session.subjects().filter(id=sid)[0]
-                nm = getattr(subj, "long_name", None) or getattr(subj, "name", None)
-                if nm: names.append(nm)
-            except Exception:
-                continue
-    except Exception:
-        pass
-    if not names:
-        s = getattr(lesson, "subject", None)
-        nm = getattr(s, "long_name", None) or getattr(s, "name", None)
-        if nm: names.append(nm)
-    return names
-
-def next_subject_day(subject: str, lessons, session, tz, base_day: date):
-    subj_low = subject.lower()
-    best = None
-    horizon = base_day + timedelta(days=35)
-    for l in lessons:
-        try: b = tz.localize(l.start)
-        except Exception: b = getattr(l, "start", None)
-        if not b: continue
-        d = b.date()
-        if not (base_day < d <= horizon): continue
-        names = get_subject_names(session, l)
-        if any(subj_low == n.lower() for n in names):
-            if best is None or d < best: best = d
-    return best or (base_day + timedelta(days=1))
+        return {s.id: nm for s in fetch_subjects()
+                if s.id in ids and (nm := getattr(s, "long_name", None) or getattr(s, "name", None))}
+    except Exception: return {}
+
+def get_subject_names(subject_map, lesson):
+    data = getattr(lesson, "_data", {}) or {}
+    return [nm for x in data.get("su", []) if (nm := subject_map.get(x.get("id")))]
+
+def next_subject_day(subject: str, subject_days, base_day: date):
+    # subject_days: Fachname klein → sortierte Liste der Unterrichtstage, einmal in main() vorberechnet
+    days = subject_days.get(subject.lower(), ())
+    i = bisect_right(days, base_day)
+    if i < len(days) and days[i] <= base_day + timedelta(days=35): return days[i]
+    return base_day + timedelta(days=1)
 
 def merge_into_blocks(intervals, max_gap_min=20):
     if not intervals: return []
-    intervals = sorted(intervals, key=lambda x: x[0])
+    # WebUntis liefert meist schon chronologisch → nur sortieren, wenn nötig
+    if any(intervals[i][0] < intervals[i-1][0] for i in range(1, len(intervals))):
+        intervals = sorted(intervals, key=itemgetter(0))
     max_gap = timedelta(minutes=max_gap_min)
-    merged = [list(intervals[0])]
+    merged = []
+    cur_b, cur_e = intervals[0]
     for b, e in intervals[1:]:
-        last_b, last_e = merged[-1]
-        if b - last_e <= max_gap:
-            if e > last_e: merged[-1][1] = e
+        if b - cur_e <= max_gap:
+            if e > cur_e: cur_e = e
         else:
-            merged.append([b, e])
-    return [(b, e) for b, e in merged]
+            merged.append((cur_b, cur_e))
+            cur_b, cur_e = b, e
+    merged.append((cur_b, cur_e))
+    return merged
+
+# ==================== ICS-Ausgabe ====================
+def format_event(uid, begin, end, summary, description=None) -> bytes:
+    # Ein VEVENT direkt als UTF-8-Bytes, ohne ics-Objektgraph
+    lines = ["BEGIN:VEVENT"]
+    if description: lines.append(f"DESCRIPTION:{ics_escape(description)}")
+    lines += [f"DTEND:{ics_utc(end)}", f"DTSTART:{ics_utc(begin)}",
+              f"SUMMARY:{ics_escape(summary)}", f"UID:{uid}", "END:VEVENT"]
+    return ("\r\n".join(ics_fold(x) for x in lines) + "\r\n").encode("utf-8")
 
 # ==================== MAIN ====================
 def main():
     load_dotenv()
     tzname = get_env("TIMEZONE", "Europe/Berlin")
-    tz = pytz.timezone(tzname)
+    tz = ZoneInfo(tzname)
     out_path = get_env("ICS_OUTPUT_PATH", "./docs/untis.ics")
-    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    out_dir = os.path.dirname(out_path)  # leer bei Dateiname ohne Pfad → makedirs("") würde scheitern
+    if out_dir and not os.path.isdir(out_dir): os.makedirs(out_dir, exist_ok=True)
     HW_TIME = time(17, 0)
 
     DEBUG = os.getenv("DEBUG_LOG", "0") == "1"
+    CACHE_TTL = int(get_env("TIMETABLE_CACHE_TTL", "0"))
 
     session = login_session()
     try:
-        start = datetime.now(tz).date()
-        end   = (datetime.now(tz) + timedelta(days=35)).date()
-        scope = pick_scope(session)
-        lessons = fetch_timetable(session, scope, start, end)
-        cal = Calendar()
-        seen_uids = set()
+        now   = datetime.now(tz)
+        start = now.date()
+        end   = (now + timedelta(days=35)).date()
+        # Fächerliste parallel zu Scope + Stundenplan laden (beides wartet nur aufs Netz)
+        with ThreadPoolExecutor(max_workers=1) as ex:
+            subjects_future = ex.submit(session.subjects)
+            scope = pick_scope(session)
+            lessons = fetch_timetable_cached(session, scope, start, end, CACHE_TTL)
+        # Lessons ohne Start/Ende gleich verwerfen → die Durchläufe unten müssen das nicht mehr prüfen
+        lessons = [l for l in lessons if getattr(l, "start", None) and getattr(l, "end", None)]
+        subject_map = load_subject_map(subjects_future.result, lessons)
 
         if DEBUG:
             print(f"[DEBUG] Lessons fetched: {len(lessons)}")
 
-        # ---------- 1) Unterricht einsammeln ----------
-        by_day = {}
-        for l in lessons:
-            try:
-                begin = tz.localize(l.start)
-                finish = tz.localize(l.end)
-            except Exception:
-                begin = getattr(l, "start", None)
-                finish = getattr(l, "end", None)
-            if not begin or not finish:
-                continue
-            if DEBUG:
-                subs = get_subject_names(session, l)
-                info = extract_info_text(l)
-                print(f"[DEBUG] {begin.date()} {begin.strftime('%H:%M')}-{finish.strftime('%H:%M')} | "
-                      f"{(subs[0] if subs else 'Fach')} | info='{info[:120].replace(chr(10),' / ')}'")
-            code = (getattr(l, "code", None) or "").lower()
-            is_cancel = getattr(l, "is_cancelled", False) or code in {"cancelled","canc","absent"}
-            if is_cancel:
-                continue
-            by_day.setdefault(begin.date(), []).append((begin, finish))
-
-        # ---------- 2) Schulblöcke ----------
-        for day, intervals in sorted(by_day.items()):
-            blocks = merge_into_blocks(intervals, max_gap_min=20)
-            for b, e in blocks:
-                ev = Event()
-                ev.name  = f"Schule {b.strftime('%H:%M')}–{e.strftime('%H:%M')}"
-                ev.begin = b
-                ev.end   = e
-                b_utc = b.astimezone(pytz.UTC).strftime("%Y%m%dT%H%M%SZ")
-                e_utc = e.astimezone(pytz.UTC).strftime("%Y%m%dT%H%M%SZ")
-                uid = f"{b_utc}-{e_utc}@untis-merged"
-                ev.uid = uid
-                if uid not in seen_uids:
-                    seen_uids.add(uid)
-                    cal.events.add(ev)
-
-        # ---------- 3) Hausaufgaben & Prüfungen ----------
-        created_hw, created_exam = set(), set()
+        # ---------- 1) Unterricht, Hausaufgaben & Prüfungen in einem Durchlauf ----------
+        by_day = defaultdict(list)
+        # HA-/Prüfungs-Events nach UID (entdoppelt zugleich), werden nach den Schulblöcken geschrieben
+        pending = {}
+        hw_slots, exam_slots = {}, {}  # due → (Beginn, Ende), mehrere HA/Prüfungen teilen sich einen Tag
         hw_count, ex_count = 0, 0
 
+        # Zeiten + Fächer einmal je Lesson; next_subject_day sucht nur noch im Index
+        rows, subject_days = [], defaultdict(set)
         for l in lessons:
-            try: begin = tz.localize(l.start)
-            except Exception: begin = getattr(l, "start", None)
-            if not begin: continue
+            begin = localize(l.start, tz)
+            subjects = get_subject_names(subject_map, l)
+            rows.append((l, begin, localize(l.end, tz), subjects))
+            for n in subjects: subject_days[n.lower()].add(begin.date())
+        subject_days = {n: sorted(ds) for n, ds in subject_days.items()}
+
+        for l, begin, finish, subjects in rows:
             base_day = begin.date()
             info = extract_info_text(l).strip()
-            subjects = get_subject_names(session, l)
+            info_low = info.lower()  # einmal pro Lesson, alle Erkennungen arbeiten darauf
             subject = subjects[0] if subjects else "Fach"
+            if DEBUG:
+                print(f"[DEBUG] {base_day} {begin.strftime('%H:%M')}-{finish.strftime('%H:%M')} | "
+                      f"{subject} | info='{info[:120].replace(chr(10),' / ')}'")
+
+            # Ausfälle zählen nicht zum Schulblock, ihre Texte können aber HA/Prüfungen enthalten
+            code = (getattr(l, "code", None) or "").lower()
+            is_cancel = getattr(l, "is_cancelled", False) or code in CANCEL_CODES
+            if not is_cancel:
+                by_day[base_day].append((begin, finish))
+
+            is_hw, is_exam = contains_homework(info_low), detect_exam(info_low)
+            parsed_due = parse_due_date(info_low, base_day) if is_hw or is_exam else None
 
             # Hausaufgabe
-            if contains_homework(info):
-                due = parse_due_date(info, base_day) or next_subject_day(subject, lessons, session, tz, base_day)
-                key = (due.isoformat(), subject, info)
-                if key not in created_hw:
-                    created_hw.add(key)
-                    hw_begin = tz.localize(datetime.combine(due, HW_TIME))
-                    hw_end   = hw_begin + timedelta(minutes=30)
-                    ev = Event()
-                    ev.name = f"{subject} – Hausaufgabe"
-                    ev.begin = hw_begin
-                    ev.end   = hw_end
-                    ev.description = info
-                    ev.uid = f"HW|{due.isoformat()}|{subject}|{abs(hash(info))}"
-                    cal.events.add(ev)
+            if is_hw:
+                due = parsed_due or next_subject_day(subject, subject_days, base_day)
+                info_digest = hashlib.blake2b(info.encode("utf-8"), digest_size=8).hexdigest()
+                uid = f"HW|{due.isoformat()}|{subject}|{info_digest}"
+                if uid not in pending:
+                    slot = hw_slots.get(due)
+                    if slot is None:
+                        hw_begin = datetime.combine(due, HW_TIME, tzinfo=tz)
+                        slot = hw_slots[due] = (hw_begin, hw_begin + timedelta(minutes=30))
+                    hw_begin, hw_end = slot
+                    pending[uid] = (uid, hw_begin, hw_end, f"{subject} – Hausaufgabe", info)
                     hw_count += 1
 
             # Prüfung
-            if detect_exam(info):
-                due = parse_due_date(info, base_day) or base_day
-                key = (due.isoformat(), subject, "exam")
-                if key not in created_exam:
-                    created_exam.add(key)
-                    ex_begin = tz.localize(datetime.combine(due, time(8, 0)))
-                    ex_end   = ex_begin + timedelta(hours=2)
-                    ev = Event()
-                    ev.name = f"Prüfung: {subject}"
-                    ev.begin = ex_begin
-                    ev.end   = ex_end
-                    ev.description = info
-                    ev.uid = f"EXAM|{due.isoformat()}|{subject}"
-                    cal.events.add(ev)
+            if is_exam:
+                due = parsed_due or base_day
+                uid = f"EXAM|{due.isoformat()}|{subject}"
+                if uid not in pending:
+                    slot = exam_slots.get(due)
+                    if slot is None:
+                        ex_begin = datetime.combine(due, time(8, 0), tzinfo=tz)
+                        slot = exam_slots[due] = (ex_begin, ex_begin + timedelta(hours=2))
+                    ex_begin, ex_end = slot
+                    pending[uid] = (uid, ex_begin, ex_end, f"Prüfung: {subject}", info)
                     ex_count += 1
 
-        # ---------- 4) Schreiben & Logs ----------
-        with open(out_path, "w", encoding="utf-8") as f:
-            f.writelines(cal.serialize_iter())
+        # Events als Text bauen (kein Calendar-Objekt im RAM) und mit einem write() ausgeben
+        chunks = [ICS_HEADER.encode()]
+        # ---------- 2) Schulblöcke ----------
+        for day, intervals in sorted(by_day.items()):
+            blocks = merge_into_blocks(intervals, max_gap_min=20)
+            for b, e in blocks:
+                uid = f"{ics_utc(b)}-{ics_utc(e)}@untis-merged"
+                chunks.append(format_event(uid, b, e, f"Schule {b.strftime('%H:%M')}–{e.strftime('%H:%M')}"))
+
+        # ---------- 3) Hausaufgaben & Prüfungen ----------
+        chunks += [format_event(*ev) for ev in pending.values()]
+        chunks.append(ICS_FOOTER.encode())
+        # Atomar ersetzen: Abonnenten (GitHub Pages) sehen nie eine halb geschriebene Datei;
+        # eindeutiger Temp-Name im Zielordner → überlappende Läufe schreiben nicht in dieselbe Datei
+        tmp = tempfile.NamedTemporaryFile(dir=out_dir or ".", prefix=".untis-", suffix=".tmp", delete=False)
+        try:
+            with tmp as f:
+                f.write(b"".join(chunks))
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(tmp.name, 0o644)  # NamedTemporaryFile legt 0600 an, die ICS ist öffentlich
+            os.replace(tmp.name, out_path)
+        except Exception:
+            try: os.remove(tmp.name)
+            except OSError: pass
+            raise
 
+        # ---------- 4) Logs ----------
         print(f"ICS geschrieben: {out_path}")
         print(f"Hausaufgaben erkannt: {hw_count}, Prüfungen erkannt: {ex_count}")
 